@@ -1,22 +1,97 @@
 import argparse
+import asyncio
+import concurrent.futures
+import functools
 import logging
 import os
+import pickle
 import re
 import sys
-import urllib
+import time
 
 from markdownify import markdownify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yaml
 
+try:
+    from yaml import CSafeDumper
+except ImportError:
+    from yaml import SafeDumper as CSafeDumper
+
+# Only advertise br when urllib3 can actually decode it
+try:
+    import brotli  # noqa: F401
+    _ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    _ACCEPT_ENCODING = 'gzip, deflate'
+
+# Only needed by AsyncWordPressApi; the sync pipeline runs without it
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 
 logging.basicConfig(stream=sys.stdout, level=logging.ERROR)
 log = logging.getLogger('wpmigrator')
 
+CACHE_DIR = '.cache'
+CACHE_TTL = 24 * 60 * 60  # seconds
+
+_TITLE_RE = re.compile(r'[^a-z0-9_]+')
+
+# Sentinel for frontmatter keys that resolved to nothing and must be omitted
+_MISSING = object()
+
+# Frontmatter keys shared by posts and pages
+_DEFAULT_CONTENT_KEYS = (
+    'id',
+    'date',
+    'date_gmt',
+    'guid',
+    'modified',
+    'modified_gmt',
+    'slug',
+    'status',
+    'type',
+    'link',
+    'title',
+    'excerpt',
+    'author',
+    'featured_media',
+    'comment_status',
+    'ping_status',
+    'sticky',
+    'template',
+    'format',
+    'meta',
+    'categories',
+    'tags',
+    'acf',
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def _md(body):
+    return markdownify(body, strip=['script', 'style'], heading_style='ATX')
+
 class WordPressApi(object):
     def __init__(self):
         self.base_url = 'https://www.data.gov/wp-json/wp/v2'
         self.client = requests.Session()
+        self.client.headers.update({
+            'Accept-Encoding': _ACCEPT_ENCODING,
+            'Connection': 'keep-alive',
+            'User-Agent': 'wpmigrator/1.0',
+        })
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.2),
+        )
+        self.client.mount('https://', adapter)
 
     def fetch_all(self, collection, **params):
         response = self.get(collection, per_page=100, **params)
@@ -27,67 +102,160 @@ class WordPressApi(object):
         log.info(f'fetch_all collection={collection} total_items={total_items} total_pages={total_pages}')
 
         if total_items == 0:
-            raise StopIteration
+            return
 
-        for page in range(1, total_pages + 1):
-            response = self.get(collection, page=page, per_page=100, order_by='id')
+        def fetch_page(page):
+            # orderby=id&order=asc makes each page a stable window over the
+            # id space, so pages can be fetched in parallel without items
+            # shifting between them (WP-JSON has no true after-id cursor)
+            response = self.get(collection, page=page, per_page=100, orderby='id', order='asc')
             response.raise_for_status()
+            return response
+
+        # Fetch all pages concurrently, but yield them in page order so the
+        # order_by=id contract holds.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            futures = [executor.submit(fetch_page, page) for page in range(1, total_pages + 1)]
+            for future in futures:
+                for item in future.result().json():
+                    log.debug(f'fetch_all {collection} id={item.get("id")} keys={item.keys()}')
+                    yield item
+
+    def get(self, path, **params):
+        response = self.client.get(f'{self.base_url}/{path}', params=params)
+        log.debug(f'get path={path} content-encoding={response.headers.get("content-encoding")}')
+        return response
+
+class AsyncWordPressApi(object):
+    # asyncio variant of WordPressApi. fetch_all is an async generator, so
+    # callers drive it from an event loop and dispatch CPU-bound template
+    # work off-loop, e.g.:
+    #
+    #     async for post in api.fetch_all('posts'):
+    #         await asyncio.to_thread(templater.template, post)
+    #
+    # HTTP/2 multiplexes the page fetches over a single connection.
+    def __init__(self):
+        if httpx is None:
+            raise ImportError('AsyncWordPressApi requires httpx[http2]')
 
+        self.base_url = 'https://www.data.gov/wp-json/wp/v2'
+        self.client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=20),
+            headers={
+                'Accept-Encoding': _ACCEPT_ENCODING,
+                'User-Agent': 'wpmigrator/1.0',
+            },
+        )
+
+    async def fetch_all(self, collection, **params):
+        response = await self.get(collection, per_page=100, **params)
+        response.raise_for_status()
+
+        total_items = int(response.headers.get('x-wp-total'))
+        total_pages = int(response.headers.get('x-wp-totalpages'))
+        log.info(f'fetch_all collection={collection} total_items={total_items} total_pages={total_pages}')
+
+        if total_items == 0:
+            return
+
+        # Fetch every page concurrently, then yield in page order to keep
+        # the orderby=id contract
+        responses = await asyncio.gather(*[
+            self.get(collection, page=page, per_page=100, orderby='id', order='asc')
+            for page in range(1, total_pages + 1)
+        ])
+        for response in responses:
+            response.raise_for_status()
             for item in response.json():
                 log.debug(f'fetch_all {collection} id={item.get("id")} keys={item.keys()}')
                 yield item
 
-    def get(self, path, **params):
-        return self.client.get(f'{self.base_url}/{path}', params=params)
+    async def get(self, path, **params):
+        response = await self.client.get(f'{self.base_url}/{path}', params=params)
+        log.debug(f'get path={path} content-encoding={response.headers.get("content-encoding")}')
+        return response
+
+    async def aclose(self):
+        await self.client.aclose()
 
 class PageTemplater(object):
-    def __init__(self, path, model_keys, tag_manager, category_manager, author_manager=None):
+    def __init__(self, path, model_keys, tag_manager, category_manager, author_manager=None, existing=None):
         self.path = path
         self.model_keys = model_keys
         self.tag_manager = tag_manager
         self.category_manager = category_manager
         self.author_manager = author_manager
+        # Filenames already written, so each write needs no stat() syscall
+        self.existing = existing if existing is not None else set()
+        # Which branch a key takes depends only on the key name, so resolve
+        # the dispatch once instead of walking an if/elif chain per model
+        self._key_handlers = [(key, self._compile_handler(key)) for key in self.model_keys]
+
+    def _compile_handler(self, key):
+        if key in ('content', 'title', 'excerpt', 'guid'):
+            return lambda model: model[key].get('rendered')
+
+        if key == 'tags':
+            return lambda model: [self.tag_manager.get_slug(tag_id) for tag_id in model[key]]
+
+        if key == 'categories':
+            return lambda model: [self.category_manager.get_slug(category_id) for category_id in model[key]]
+
+        if key == 'author':
+            def author_slug(model):
+                try:
+                    return self.author_manager.get_slug(model[key])
+                except KeyError:
+                    log.error(f'author={model[key]} not found')
+                    return _MISSING
+            return author_slug
 
-    def template_frontmatter(self, model, additional=None):
+        return lambda model: model[key]
+
+    def frontmatter_data(self, model, additional=None):
         data = {}
-        for key in self.model_keys:
+        for key, handler in self._key_handlers:
             if key not in model:
                 continue
 
-            if key in ['content', 'title', 'excerpt', 'guid']:
-                data[key] = model.get(key).get('rendered')
-            elif key == 'tags':
-                data[key] = [self.tag_manager.get_slug(tag_id) for tag_id in model.get(key)]
-            elif key == 'categories':
-                data[key] = [self.category_manager.get_slug(category_id) for category_id in model.get(key)]
-            elif key == 'author':
-                try:
-                    data[key] = self.author_manager.get_slug(model.get(key))
-                except KeyError as e:
-                    log.error(f'author={model.get(key)} not found')
-            else:
-                data[key] = model.get(key)
+            value = handler(model)
+            if value is not _MISSING:
+                data[key] = value
 
         if additional:
             data.update(additional)
 
-        return yaml.dump(data)
+        return data
+
+    def dump_frontmatter(self, model, additional, stream):
+        # Dump straight into the file buffer instead of materializing the
+        # whole YAML document as a string first
+        yaml.dump(self.frontmatter_data(model, additional), stream,
+                  Dumper=CSafeDumper, default_flow_style=False, sort_keys=False, allow_unicode=True)
 
     def template_body(self, model):
-        return model.get('content', {}).get('rendered')
+        body = model.get('content', {}).get('rendered')
+        if not body or body.isspace():
+            return ''
+
+        return body
 
-    def redirects(self, model):
+    def redirects(self, model, permalink=None):
         # Only posts have multiple URLs for some reason
         if model.get('type') != 'post':
             return []
 
-        permalink = self.permalink(model)
+        if permalink is None:
+            permalink = self.permalink(model)
         title = permalink.split('/')[-2]
 
         # TODO Need to add category parents here too
         redirects = set()
         for category_id in model.get('categories'):
-            redirect = f'/{self.category_manager.get_slug(category_id)}/{title}/'
+            slug = self.category_manager.get_slug(category_id)
+            redirect = f'/{slug}/{title}/'
 
             if permalink == redirect:
                 continue
@@ -101,12 +269,13 @@ class PageTemplater(object):
             if parent_category_id != 0:
                 redirects.add(f'/{self.category_manager.get_slug(parent_category_id)}{redirect}')
 
-        return sorted(list(redirects))
+        return sorted(redirects)
 
 
     def permalink(self, model):
-        url = urllib.parse.urlparse(model.get('link'))
-        path = url.path
+        # Every link is an absolute URL on the site origin, so slice off
+        # scheme and host instead of urlparse-ing each model
+        path = '/' + model.get('link').split('/', 3)[-1]
         # Make sure to end with a /
         if not path.endswith('/'):
             path = path + '/'
@@ -121,56 +290,72 @@ class PageTemplater(object):
     def template(self, model):
         additional = {}
         additional['layout'] = 'legacy-%s' % model.get('type')
-        additional['permalink'] = self.permalink(model)
-        additional['redirect_from'] = self.redirects(model)
-        frontmatter = self.template_frontmatter(model, additional)
+        # Parse the permalink once; redirects needs it too
+        permalink = self.permalink(model)
+        additional['permalink'] = permalink
+        additional['redirect_from'] = self.redirects(model, permalink)
         body = self.template_body(model)
         filename = self.get_filename(model)
 
         try:
+            markdown = _md(body) if body else ''
             with self.file_writer(filename) as f:
                 f.write('---\n')
-                f.write(frontmatter)
-                f.write('---\n')
-                f.write(markdownify(body))
+                self.dump_frontmatter(model, additional, f)
+                f.write(f'---\n{markdown}')
         except Exception as e:
             log.exception(e)
 
     def file_writer(self, filename):
         path = os.path.join(self.path, filename)
         log.info(f'writing data for {path}')
-        if os.path.exists(path):
+        if filename in self.existing:
+            raise Exception(f'path={path} already exists')
+
+        self.existing.add(filename)
+
+        # O_EXCL checks and creates in a single syscall, so there's no race
+        # between the existence check and the open
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
             raise Exception(f'path={path} already exists')
 
-        return open(path, 'wt')
+        # Large buffer so each file goes out in a single write() syscall
+        return os.fdopen(fd, 'w', buffering=262144)
 
 class PostTemplater(PageTemplater):
     def get_filename(self, model):
-        pattern = r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})T(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})'
-        title = re.sub(r'[^a-z0-9_]+', '-', model.get('title').get('rendered').lower())
-        date = re.match(pattern, model.get('date'))
-        return '%s-%s-%s-%s.md' % (date.group('year'), date.group('month'), date.group('day'), title)
+        title = _TITLE_RE.sub('-', model.get('title').get('rendered').lower())
+        # WP-JSON dates are always ISO 8601 (2014-02-21T16:14:23), so slice
+        # instead of matching a regex per post
+        date = model.get('date')
+        return '%s-%s-%s-%s.md' % (date[:4], date[5:7], date[8:10], title)
 
 
 class DataTemplater(PageTemplater):
     def template(self, model):
-        frontmatter = self.template_frontmatter(model)
         filename = '%s.yml' % model.get('slug')
 
         with self.file_writer(filename) as f:
-            f.write(frontmatter)
+            self.dump_frontmatter(model, None, f)
 
-    def template_frontmatter(self, model):
+    def frontmatter_data(self, model, additional=None):
         data = {}
         for key in self.model_keys:
             if key in model:
                 data[key] = model.get(key)
 
-        return yaml.dump(data)
+        return data
+
 
 
+def index_authors(api, author_manager):
+    for author in api.fetch_all('users'):
+        author_manager.add(author)
+
 
-def template_authors(output, api, tag_manager, category_manager, author_manager):
+def template_authors(output, authors, tag_manager, category_manager):
     author_keys = [
         'id',
         'name',
@@ -182,10 +367,13 @@ def template_authors(output, api, tag_manager, category_manager, author_manager)
     ]
     authors_path = os.path.join(output, '_data', 'authors')
     os.makedirs(authors_path, exist_ok=True)
-    templater = DataTemplater(authors_path, author_keys, tag_manager, category_manager)
-    for author in api.fetch_all('users'):
-        templater.template(author)
-        author_manager.add(author)
+    existing = set(os.listdir(authors_path))
+    templater = DataTemplater(authors_path, author_keys, tag_manager, category_manager, existing=existing)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(templater.template, author) for author in authors]
+
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 def index_categories(api, category_manager):
     for category in api.fetch_all('categories'):
@@ -198,85 +386,48 @@ def index_tags(api, tag_manager):
 
 
 def template_posts(output, api, tag_manager, category_manager, author_manager):
-    posts_keys = [
-        'id',
-        'date',
-        'date_gmt',
-        'guid',
-        'modified',
-        'modified_gmt',
-        'slug',
-        'status',
-        'type',
-        'link',
-        'title',
-        'excerpt',
-        'author',
-        'featured_media',
-        'comment_status',
-        'ping_status',
-        'sticky',
-        'template',
-        'format',
-        'meta',
-        'categories',
-        'tags',
-        'acf',
-    ]
     posts_path = os.path.join(output, '_posts')
     os.makedirs(posts_path, exist_ok=True)
-    templater = PostTemplater(posts_path, posts_keys, tag_manager, category_manager, author_manager)
-    for post in api.fetch_all('posts'):
-        if tag_manager.is_filtered(post.get('tags')):
-            # Skip any posts tagged with a filtered tag
-            log.debug(f'skipping post={post.get("title")}')
-            continue
+    existing = set(os.listdir(posts_path))
+    templater = PostTemplater(posts_path, _DEFAULT_CONTENT_KEYS, tag_manager, category_manager, author_manager, existing=existing)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = []
+        for post in api.fetch_all('posts'):
+            if tag_manager.is_filtered(post.get('tags')):
+                # Skip any posts tagged with a filtered tag
+                log.debug(f'skipping post={post.get("title")}')
+                continue
 
-        templater.template(post)
-        # For each category...
+            futures.append(executor.submit(templater.template, post))
+            # For each category...
+
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 def template_pages(output, api, tag_manager, category_manager, author_manager):
-    pages_keys = [
-        'id',
-        'date',
-        'date_gmt',
-        'guid',
-        'modified',
-        'modified_gmt',
-        'slug',
-        'status',
-        'type',
-        'link',
-        'title',
-        'excerpt',
-        'author',
-        'featured_media',
-        'comment_status',
-        'ping_status',
-        'sticky',
-        'template',
-        'format',
-        'meta',
-        'categories',
-        'tags',
-        'acf',
-    ]
-    templater = PageTemplater(output, pages_keys, tag_manager, category_manager, author_manager)
-    for page in api.fetch_all('pages'):
-        templater.template(page)
+    os.makedirs(output, exist_ok=True)
+    existing = set(os.listdir(output))
+    templater = PageTemplater(output, _DEFAULT_CONTENT_KEYS, tag_manager, category_manager, author_manager, existing=existing)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = []
+        for page in api.fetch_all('pages'):
+            futures.append(executor.submit(templater.template, page))
 
-        # Create redirects for...
-        # slug...
-        # each category...
+            # Create redirects for...
+            # slug...
+            # each category...
+
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 class EntityManager(object):
     def __init__(self, filter_list=None):
         self.tag_index = {}
-        self.filtered_ids = []
+        self.filtered_ids = set()
 
-        self.filter_list = []
+        self.filter_list = set()
         if filter_list:
-            self.filter_list = filter_list
+            self.filter_list = set(filter_list)
 
     def get_slug(self, tag_id):
         return self.tag_index[tag_id].get('slug')
@@ -290,12 +441,34 @@ class EntityManager(object):
             raise Exception(f'Entity id={id} already exists')
 
         if tag.get('name') in self.filter_list:
-            self.filtered_ids.append(id)
+            self.filtered_ids.add(id)
 
         self.tag_index[id] = tag
 
     def is_filtered(self, tag_list):
-        return any(tag_id in self.filtered_ids for tag_id in tag_list)
+        return not self.filtered_ids.isdisjoint(tag_list)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def load_cached_manager(path, ttl=CACHE_TTL):
+    if not os.path.exists(path):
+        return None
+
+    if time.time() - os.path.getmtime(path) > ttl:
+        log.info(f'cache path={path} is older than ttl={ttl}s, refetching')
+        return None
+
+    log.info(f'loading cached index from path={path}')
+    return EntityManager.load(path)
 
 
 class Page(object):
@@ -320,18 +493,34 @@ def main():
     api = WordPressApi()
     # Get an index of categories
     log.info('Getting an index of categories...')
-    category_manager = EntityManager()
-    index_categories(api, category_manager)
+    categories_cache = os.path.join(CACHE_DIR, 'categories.pkl')
+    category_manager = load_cached_manager(categories_cache)
+    if category_manager is None:
+        category_manager = EntityManager()
+        index_categories(api, category_manager)
+        category_manager.save(categories_cache)
 
     # Get an index of tags
     log.info('Getting an index of tags...')
-    tag_manager = EntityManager(['usdatagov'])
-    index_tags(api, tag_manager)
+    tags_cache = os.path.join(CACHE_DIR, 'tags.pkl')
+    tag_manager = load_cached_manager(tags_cache)
+    if tag_manager is None:
+        tag_manager = EntityManager(['usdatagov'])
+        index_tags(api, tag_manager)
+        tag_manager.save(tags_cache)
 
     # Get an index of authors/users
+    log.info('Getting an index of authors...')
+    authors_cache = os.path.join(CACHE_DIR, 'authors.pkl')
+    author_manager = load_cached_manager(authors_cache)
+    if author_manager is None:
+        author_manager = EntityManager()
+        index_authors(api, author_manager)
+        author_manager.save(authors_cache)
+
+    # Template authors even on a cache hit; the output dir may be fresh
     log.info('Templating authors...')
-    author_manager = EntityManager()
-    template_authors(args.output, api, tag_manager, category_manager, author_manager)
+    template_authors(args.output, author_manager.tag_index.values(), tag_manager, category_manager)
 
     # Iterate over posts
     log.info('Templating posts...')